@@ -3,8 +3,300 @@
 比较两个 PPM 文件并生成统计信息
 """
 
+import os
 import sys
-from typing import Tuple, List
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple, List, Optional
+
+import numpy as np
+
+BLOCK_SIZE = 64 << 20
+LINE_INDEX_BLOCK = 1 << 20
+MIN_CHUNK_SIZE = 8 << 20
+HEADER_LINES = 3
+
+def first_diff_offset(file1: str, file2: str) -> Optional[int]:
+    """逐块比较两个文件的字节内容，返回第一个不同字节的偏移（完全相同时返回 None）"""
+    size1, size2 = os.path.getsize(file1), os.path.getsize(file2)
+    size = min(size1, size2)
+    if size > 0:
+        m1 = np.memmap(file1, dtype=np.uint8, mode='r')
+        m2 = np.memmap(file2, dtype=np.uint8, mode='r')
+        for start in range(0, size, BLOCK_SIZE):
+            end = min(start + BLOCK_SIZE, size)
+            diff = np.flatnonzero(m1[start:end] != m2[start:end])
+            if diff.size:
+                return start + int(diff[0])
+    # 一个文件是另一个的前缀时，第一个不同之处在较短文件的末尾
+    return None if size1 == size2 else size
+
+def files_identical(file1: str, file2: str) -> bool:
+    """逐块比较两个文件的字节内容"""
+    return os.path.getsize(file1) == os.path.getsize(file2) and first_diff_offset(file1, file2) is None
+
+def index_lines(path: str) -> np.ndarray:
+    """
+    扫描一次文件，返回每 LINE_INDEX_BLOCK 字节小块结束处的累计换行符个数
+
+    最后一个元素即换行符总数（行数见 count_lines）；line_offsets 借助该索引只需重扫切分点所在的小块
+    """
+    if os.path.getsize(path) == 0:
+        return np.zeros(1, dtype=np.int64)
+
+    m = np.memmap(path, dtype=np.uint8, mode='r')
+    counts = [np.count_nonzero(m[start:start + LINE_INDEX_BLOCK] == ord('\n'))
+              for start in range(0, len(m), LINE_INDEX_BLOCK)]
+    return np.cumsum(counts, dtype=np.int64)
+
+def count_lines(path: str, index: np.ndarray) -> int:
+    """文件行数：换行符个数，最后一行没有换行符时再加一行"""
+    if os.path.getsize(path) == 0:
+        return 0
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return int(index[-1]) + (f.read(1) != b'\n')
+
+def line_offsets(path: str, lines: List[int], index: np.ndarray) -> List[int]:
+    """
+    返回各行（行号从 0 开始，升序）起始位置的字节偏移
+
+    index 为 index_lines 的结果；行号等于文件行数时返回文件大小（即最后一行的结束位置），
+    超出文件行数的行号被忽略（返回列表变短）
+    """
+    m = None
+    offsets = []
+    total = count_lines(path, index)
+    for line in lines:
+        if line == 0:
+            offsets.append(0)
+            continue
+        if line > index[-1]:
+            # 最后一行没有换行符时，它的结束位置就是文件末尾
+            if line == total:
+                offsets.append(os.path.getsize(path))
+            break
+
+        # 第 k 行从第 k 个换行符之后开始，先定位包含该换行符的小块
+        block = int(np.searchsorted(index, line))
+        before = int(index[block - 1]) if block else 0
+        start = block * LINE_INDEX_BLOCK
+        if m is None:
+            m = np.memmap(path, dtype=np.uint8, mode='r')
+        newlines = np.flatnonzero(m[start:start + LINE_INDEX_BLOCK] == ord('\n'))
+        offsets.append(start + int(newlines[line - before - 1]) + 1)
+    return offsets
+
+def read_ppm_header(path: str) -> List[bytes]:
+    """读取 PPM 头部（magic、尺寸、maxval 三行，不支持注释行）"""
+    with open(path, 'rb') as f:
+        return [f.readline() for _ in range(HEADER_LINES)]
+
+def map_p6_pixels(path: str, header: List[bytes]) -> np.ndarray:
+    """将 P6 文件的像素区映射为 (N, 3) 数组（不读入内存）"""
+    dtype = '>u2' if int(header[2]) > 255 else 'u1'
+    return np.memmap(path, dtype=dtype, mode='r', offset=len(b''.join(header))).reshape(-1, 3)
+
+def first_ragged_line(data: bytes, lines: int) -> Optional[int]:
+    """
+    返回 data（从行首开始，共 lines 行）中第一个不是 3 个值的行（从 0 开始），都是 3 个值时返回 None
+
+    第 j 个换行符必须落在第 3j+3 和第 3j+4 个值之间，只需比较值的起点和换行符的位置
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    space = buf <= ord(' ')
+    # 值的起点：非空白字节，且位于开头或紧跟空白之后
+    starts = np.flatnonzero(space[:-1] > space[1:]) + 1
+    if buf.size and not space[0]:
+        starts = np.concatenate(([0], starts))
+    if starts.size != 3 * lines:
+        return 0
+
+    newlines = np.flatnonzero(buf == ord('\n'))[:lines]
+    triples = starts.reshape(-1, 3)
+    n = newlines.size
+    ok = triples[:n, 2] < newlines
+    ok[:lines - 1] &= newlines[:lines - 1] < triples[1:n + 1, 0]
+    bad = np.flatnonzero(~ok)
+    return int(bad[0]) if bad.size else None
+
+def load_p3_pixels(path: str, start: int, end: int, lines: int) -> np.ndarray:
+    """解析 P3 文件 [start, end) 字节范围内的 lines 行像素为 (N, 3) 数组（每行一个像素）"""
+    if end <= start:
+        return np.empty((0, 3), dtype=np.int32)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    # 直接按空白分隔解析 bytes，不经过逐行拆分和 str 解码
+    values = np.fromstring(data, dtype=np.int32, sep=' ')
+    if values.size != 3 * lines:
+        raise ValueError(f"{path}: 字节 {start}-{end} 内 {lines} 行像素数据解析出 {values.size} 个值")
+
+    # 总数相同也可能是多值行和少值行互相抵消，逐行统计值的个数
+    bad = first_ragged_line(data, lines)
+    if bad is not None:
+        raise ValueError(f"{path}: 字节 {start} 起第 {bad + 1} 行像素数据不是 3 个值")
+    return values.reshape(-1, 3)
+
+def diff_header(stats: dict, header1: List[bytes], header2: List[bytes], sample_lines: int):
+    """逐行对比头部，结果写入 stats"""
+    for line_num, (line1, line2) in enumerate(zip(header1, header2), 1):
+        stats['total_lines'] += 1
+        if line1 != line2:
+            stats['diff_lines'] += 1
+            if stats['first_diff_line'] is None:
+                stats['first_diff_line'] = line_num
+            if len(stats['sample_diffs']) < sample_lines:
+                stats['sample_diffs'].append({
+                    'line': line_num,
+                    'file1': line1.decode(errors='replace').strip(),
+                    'file2': line2.decode(errors='replace').strip()
+                })
+
+def diff_block(px1: np.ndarray, px2: np.ndarray, first_line: int,
+               sample_lines: int) -> Tuple[int, int, Optional[int], List[dict]]:
+    """
+    对比两个等长的 (N, 3) 像素块
+
+    Args:
+        first_line: 块内第一个像素所在的行号（P3 中第 i 个像素位于行 i + 4）
+
+    Returns:
+        (不同行数, 最大通道差异, 第一个差异行号, 差异样本)
+    """
+    a = np.asarray(px1, dtype=np.int32)
+    b = np.asarray(px2, dtype=np.int32)
+
+    # 通道差值只算一次，同时用于差异行判定和最大值归约
+    diff = a - b
+    np.abs(diff, out=diff)
+    diff_mask = diff.any(axis=1)
+    diff_lines = int(np.count_nonzero(diff_mask))
+    if not diff_lines:
+        return 0, 0, None, []
+
+    # 样本已取满（sample_lines <= 0）时不再定位其余差异行
+    samples = [{
+        'line': first_line + int(i),
+        'file1': ' '.join(map(str, a[i])),
+        'file2': ' '.join(map(str, b[i]))
+    } for i in np.flatnonzero(diff_mask)[:sample_lines]] if sample_lines > 0 else []
+    return diff_lines, int(diff.max()), first_line + int(diff_mask.argmax()), samples
+
+def diff_p3_chunk(file1: str, range1: Tuple[int, int, int], file2: str, range2: Tuple[int, int, int],
+                  first_line: int, sample_lines: int) -> Tuple[int, int, Optional[int], List[dict]]:
+    """解析并对比两个文件中对应的一段像素行（可在子进程中运行）"""
+    px1 = load_p3_pixels(file1, *range1)
+    px2 = load_p3_pixels(file2, *range2)
+    return diff_block(px1, px2, first_line, sample_lines)
+
+def merge_block(stats: dict, result: Tuple[int, int, Optional[int], List[dict]], sample_lines: int):
+    """将 diff_block 的结果合并到 stats（需按行号顺序调用）"""
+    diff_lines, max_diff, first_diff_line, samples = result
+    stats['diff_lines'] += diff_lines
+    stats['max_channel_diff'] = max(stats['max_channel_diff'], max_diff)
+    if stats['first_diff_line'] is None:
+        stats['first_diff_line'] = first_diff_line
+    stats['sample_diffs'].extend(samples[:max(sample_lines - len(stats['sample_diffs']), 0)])
+
+def line_around(path: str, offset: int) -> Tuple[int, bytes]:
+    """返回字节偏移 offset 所在行的行号（从 1 开始）和该行内容（不含换行符）"""
+    size = os.path.getsize(path)
+    if size == 0:
+        return 1, b''
+    m = np.memmap(path, dtype=np.uint8, mode='r')
+    line_num = 1 + sum(int(np.count_nonzero(m[start:min(start + BLOCK_SIZE, offset)] == ord('\n')))
+                       for start in range(0, offset, BLOCK_SIZE))
+    with open(path, 'rb') as f:
+        f.seek(max(0, offset - LINE_INDEX_BLOCK))
+        before = f.read(min(offset, LINE_INDEX_BLOCK))
+        line = before[before.rfind(b'\n') + 1:] + f.readline()
+    return line_num, line.rstrip(b'\n')
+
+def diff_bytes(stats: dict, file1: str, file2: str, sample_lines: int):
+    """
+    字节不同但逐像素数值相同（空白、换行等格式差异）时，把第一个不同字节所在行计为一处差异
+    """
+    offset = first_diff_offset(file1, file2)
+    if offset is None:
+        return
+
+    # 第一个不同字节之前两个文件完全相同，行号和行首位置也相同
+    line_num, line1 = line_around(file1, offset)
+    _, line2 = line_around(file2, offset)
+    stats['diff_lines'] += 1
+    stats['first_diff_line'] = line_num
+    if sample_lines > 0:
+        stats['sample_diffs'].append({
+            'line': line_num,
+            'file1': repr(line1.decode(errors='replace')),
+            'file2': repr(line2.decode(errors='replace'))
+        })
+
+def warn_length_mismatch(count1: int, count2: int):
+    """文件像素数不同时打印警告"""
+    if count1 != count2:
+        print(f"⚠ 警告: 文件长度不同!")
+        if count1 > count2:
+            print(f"  文件1 还有 {count1 - count2} 个像素")
+        else:
+            print(f"  文件2 还有 {count2 - count1} 个像素")
+
+def compare_p6(stats: dict, file1: str, file2: str, header1: List[bytes], header2: List[bytes],
+               sample_lines: int):
+    """对比两个 P6 文件的像素区"""
+    px1 = map_p6_pixels(file1, header1)
+    px2 = map_p6_pixels(file2, header2)
+    n = min(len(px1), len(px2))
+    stats['total_lines'] += n
+
+    # 按约 MIN_CHUNK_SIZE 字节分块对比，int32 差值等中间数组不随图像大小增长
+    block = max(1, MIN_CHUNK_SIZE // (3 * max(px1.itemsize, px2.itemsize)))
+    for start in range(0, n, block):
+        end = min(start + block, n)
+        remaining = sample_lines - len(stats['sample_diffs'])
+        result = diff_block(px1[start:end], px2[start:end], HEADER_LINES + 1 + start, remaining)
+        merge_block(stats, result, sample_lines)
+    warn_length_mismatch(len(px1), len(px2))
+
+def compare_p3(stats: dict, file1: str, file2: str, sample_lines: int):
+    """
+    对比两个 P3 文件的像素区
+
+    按行号把像素区切成约 MIN_CHUNK_SIZE 大小的若干段，逐段解析和对比，
+    内存占用只与段大小有关；多核时各段在子进程中并行处理。
+    两个文件同一像素的字节偏移不同，所以切分点按行号对齐而不是按字节。
+    """
+    # 每个文件只完整扫描一次：行数和切分点偏移都来自同一个行索引
+    index1 = index_lines(file1)
+    index2 = index_lines(file2)
+    count1 = count_lines(file1, index1) - HEADER_LINES
+    count2 = count_lines(file2, index2) - HEADER_LINES
+    n = max(min(count1, count2), 0)
+    stats['total_lines'] += n
+
+    body_size = max(os.path.getsize(file1), os.path.getsize(file2))
+    chunks = max(1, min(body_size // MIN_CHUNK_SIZE, n))
+    workers = min(os.cpu_count() or 1, chunks)
+    bounds = [HEADER_LINES + n * k // chunks for k in range(chunks + 1)]
+    offsets1 = line_offsets(file1, bounds, index1)
+    offsets2 = line_offsets(file2, bounds, index2)
+
+    # 每段为 (起始偏移, 结束偏移, 行数)，行数由切分点直接得出，解析时无需再数换行符
+    args = [(file1, (offsets1[k], offsets1[k + 1], bounds[k + 1] - bounds[k]),
+             file2, (offsets2[k], offsets2[k + 1], bounds[k + 1] - bounds[k]), bounds[k] + 1)
+            for k in range(chunks)]
+    if workers == 1:
+        # 顺序处理时只向后续段请求尚缺的样本数，样本取满后不再构造样本
+        for chunk_args in args:
+            remaining = sample_lines - len(stats['sample_diffs'])
+            merge_block(stats, diff_p3_chunk(*chunk_args, remaining), sample_lines)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(diff_p3_chunk, *zip(*args), [sample_lines] * chunks)
+            for result in results:
+                merge_block(stats, result, sample_lines)
+    warn_length_mismatch(count1, count2)
 
 def compare_ppm_files(file1: str, file2: str, sample_lines: int = 5) -> dict:
     """
@@ -28,45 +320,32 @@ def compare_ppm_files(file1: str, file2: str, sample_lines: int = 5) -> dict:
     }
 
     try:
-        with open(file1) as f1, open(file2) as f2:
-            for line_num, (line1, line2) in enumerate(zip(f1, f2), 1):
-                stats['total_lines'] += 1
-
-                if line1 != line2:
-                    stats['diff_lines'] += 1
-
-                    # 记录第一个差异
-                    if stats['first_diff_line'] is None:
-                        stats['first_diff_line'] = line_num
-
-                    # 保存差异样本
-                    if len(stats['sample_diffs']) < sample_lines:
-                        stats['sample_diffs'].append({
-                            'line': line_num,
-                            'file1': line1.strip(),
-                            'file2': line2.strip()
-                        })
-
-                    # 如果是像素数据行，计算最大通道差异
-                    try:
-                        vals1 = list(map(int, line1.strip().split()))
-                        vals2 = list(map(int, line2.strip().split()))
-                        if len(vals1) == 3 and len(vals2) == 3:
-                            for v1, v2 in zip(vals1, vals2):
-                                diff = abs(v1 - v2)
-                                stats['max_channel_diff'] = max(stats['max_channel_diff'], diff)
-                    except:
-                        pass
-
-            # 检查文件长度是否相同
-            remaining1 = list(f1)
-            remaining2 = list(f2)
-            if remaining1 or remaining2:
-                print(f"⚠ 警告: 文件长度不同!")
-                if remaining1:
-                    print(f"  文件1 还有 {len(remaining1)} 行")
-                if remaining2:
-                    print(f"  文件2 还有 {len(remaining2)} 行")
+        header1 = read_ppm_header(file1)
+        header2 = read_ppm_header(file2)
+        magic1, magic2 = header1[0].strip(), header2[0].strip()
+
+        if magic1 != magic2:
+            print(f"✗ 错误: PPM 格式不同 - {magic1.decode()} vs {magic2.decode()}")
+            sys.exit(1)
+
+        # 快速路径：字节完全相同时无需解析像素
+        if files_identical(file1, file2):
+            if magic1 == b'P6':
+                stats['total_lines'] = len(header1) + len(map_p6_pixels(file1, header1))
+            else:
+                stats['total_lines'] = count_lines(file1, index_lines(file1))
+            return stats
+
+        # P3 按文本解析，P6 直接映射二进制像素区
+        diff_header(stats, header1, header2, sample_lines)
+        if magic1 == b'P6':
+            compare_p6(stats, file1, file2, header1, header2, sample_lines)
+        else:
+            compare_p3(stats, file1, file2, sample_lines)
+
+        # 字节不同却没有找到数值差异时，也不能报告完全一致
+        if stats['diff_lines'] == 0:
+            diff_bytes(stats, file1, file2, sample_lines)
 
         # 计算差异率
         if stats['total_lines'] > 0:
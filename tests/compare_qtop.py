@@ -9,22 +9,91 @@
     python3 compare_qtop.py ../raw/DP3Q0109.X3F /tmp
 """
 
+import glob
+import hashlib
+import io
 import os
+import shlex
 import subprocess
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 from PIL import Image
 
+from compare_ppm import HEADER_LINES, MIN_CHUNK_SIZE, count_lines, index_lines, line_offsets, read_ppm_header
+
+# go list 模板：每个非标准库依赖包输出一行，目录和源文件名以 tab 分隔
+GO_LIST_TEMPLATE = (
+    '{{if not .Standard}}{{.Dir}}'
+    '{{range .GoFiles}}{{"\\t"}}{{.}}{{end}}{{range .CgoFiles}}{{"\\t"}}{{.}}{{end}}'
+    '{{range .CFiles}}{{"\\t"}}{{.}}{{end}}{{range .CXXFiles}}{{"\\t"}}{{.}}{{end}}'
+    '{{range .HFiles}}{{"\\t"}}{{.}}{{end}}{{end}}'
+)
+
+# x3f/denoise_opencv.go 的 cgo LDFLAGS 链接的 OpenCV 静态库
+OPENCV_STATIC_LIBS = "build/opencv-install/lib/**/*.a"
+
+
+def run_command(args):
+    """运行命令（不经过 shell），返回退出码和 stderr；stdout 直接丢弃，命令无法启动时返回 127 和错误信息"""
+    try:
+        result = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    except OSError as e:
+        return 127, str(e)
+    return result.returncode, result.stderr
+
+
+def go_build_inputs(package="./cmd/x3f-go"):
+    """返回编译 package 所需的源文件（go list 得到的依赖包）、go.mod/go.sum 和 OpenCV 静态库"""
+    try:
+        result = subprocess.run(
+            ["go", "list", "-deps", "-f", GO_LIST_TEMPLATE, package],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+        )
+    except OSError:
+        return None
+    if result.returncode != 0:
+        return None
+
+    inputs = ["go.mod", "go.sum"]
+    for line in result.stdout.splitlines():
+        if line:
+            pkg_dir, *files = line.split("\t")
+            inputs.extend(os.path.join(pkg_dir, name) for name in files)
+    inputs.extend(glob.glob(OPENCV_STATIC_LIBS, recursive=True))
+    return inputs
+
+
+def go_binary_up_to_date(go_binary):
+    """Go 可执行文件比所有编译输入都新时返回 True（go list 失败或找不到 go 时视为需要重新编译）"""
+    if not os.path.exists(go_binary):
+        return False
+
+    inputs = go_build_inputs()
+    if inputs is None:
+        return False
 
-def run_command(cmd):
-    """运行命令并返回结果"""
-    result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-    return result.returncode, result.stdout, result.stderr
+    built = os.path.getmtime(go_binary)
+    return all(os.path.getmtime(path) <= built for path in inputs if os.path.exists(path))
 
 
-def generate_c_qtop(x3f_file, output_dir):
-    """生成 C 版本的 qtop 输出"""
+def file_digest(path):
+    """计算文件内容的 SHA-1（用于缓存文件名）"""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def is_cache_valid(path, *deps):
+    """缓存文件存在且比所有依赖文件（输入文件、可执行文件）都新时返回 True"""
+    return os.path.exists(path) and all(os.path.getmtime(path) > os.path.getmtime(dep) for dep in deps)
+
+
+def generate_c_qtop(x3f_file, output_dir, digest):
+    """生成 C 版本的 qtop 输出（相同输入已有输出时直接复用）"""
     c_extract = "../bin/c-osx-universal/x3f_extract"
 
     if not os.path.exists(c_extract):
@@ -32,16 +101,21 @@ def generate_c_qtop(x3f_file, output_dir):
         return None
 
     basename = os.path.basename(x3f_file)
+    cached_path = os.path.join(output_dir, f"{basename}.{digest[:8]}.tif")
+    if is_cache_valid(cached_path, x3f_file, c_extract):
+        print(f"使用 C 版本缓存: {cached_path}")
+        return cached_path
+
     tiff_path = os.path.join(output_dir, f"{basename}.tif")
 
     # 删除旧文件
     if os.path.exists(tiff_path):
         os.remove(tiff_path)
 
-    cmd = f"{c_extract} -tiff -qtop -no-crop -o {output_dir} {x3f_file}"
-    print(f"运行 C 版本: {cmd}")
+    cmd = [c_extract, "-tiff", "-qtop", "-no-crop", "-o", output_dir, x3f_file]
+    print(f"运行 C 版本: {shlex.join(cmd)}")
 
-    returncode, stdout, stderr = run_command(cmd)
+    returncode, stderr = run_command(cmd)
 
     if returncode != 0:
         print(f"C 版本执行失败: {stderr}")
@@ -51,42 +125,107 @@ def generate_c_qtop(x3f_file, output_dir):
         print(f"错误: C 版本未生成输出文件: {tiff_path}")
         return None
 
-    return tiff_path
+    # C 版本的输出文件名固定，重命名为带内容哈希的缓存文件
+    os.replace(tiff_path, cached_path)
+    return cached_path
 
 
-def generate_go_qtop(x3f_file, output_dir):
-    """生成 Go 版本的 qtop 输出"""
+def generate_go_qtop(x3f_file, output_dir, digest):
+    """生成 Go 版本的 qtop 输出（相同输入已有输出时直接复用）"""
     go_binary = "/tmp/x3f-go"
 
-    # 编译 Go 版本
-    print("编译 Go 版本...")
-    compile_cmd = "go build -o /tmp/x3f-go ./cmd/x3f-go"
-    returncode, _, stderr = run_command(compile_cmd)
+    # 编译 Go 版本（源码未修改时跳过）
+    if go_binary_up_to_date(go_binary):
+        print(f"Go 版本已是最新，跳过编译: {go_binary}")
+    else:
+        print("编译 Go 版本...")
+        compile_cmd = ["go", "build", "-o", go_binary, "./cmd/x3f-go"]
+        returncode, stderr = run_command(compile_cmd)
 
-    if returncode != 0:
-        print(f"Go 编译失败: {stderr}")
-        return None
+        if returncode != 0:
+            print(f"Go 编译失败: {stderr}")
+            return None
 
+    cached_path = os.path.join(output_dir, f"go_qtop.{digest[:8]}.ppm")
+    if is_cache_valid(cached_path, x3f_file, go_binary):
+        print(f"使用 Go 版本缓存: {cached_path}")
+        return cached_path
+
+    # 先写到不带哈希的文件，成功后再重命名，避免中断或失败留下的半截文件被当作缓存
     ppm_path = os.path.join(output_dir, "go_qtop.ppm")
 
     # 删除旧文件
     if os.path.exists(ppm_path):
         os.remove(ppm_path)
 
-    cmd = f"{go_binary} -qtop -no-crop -o {ppm_path} {x3f_file}"
-    print(f"运行 Go 版本: {cmd}")
+    cmd = [go_binary, "-qtop", "-no-crop", "-o", ppm_path, x3f_file]
+    print(f"运行 Go 版本: {shlex.join(cmd)}")
 
-    returncode, stdout, stderr = run_command(cmd)
+    returncode, stderr = run_command(cmd)
 
     if returncode != 0:
         print(f"Go 版本执行失败: {stderr}")
+        if os.path.exists(ppm_path):
+            os.remove(ppm_path)
         return None
 
     if not os.path.exists(ppm_path):
         print(f"错误: Go 版本未生成输出文件: {ppm_path}")
         return None
 
-    return ppm_path
+    os.replace(ppm_path, cached_path)
+    return cached_path
+
+
+def load_first_channel(ppm_path, start, end, lines):
+    """解析 P3 文件 [start, end) 字节范围内 lines 行中每行的第一个值（灰度图 R=G=B，只需一个通道）"""
+    with open(ppm_path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    values = np.loadtxt(io.BytesIO(data), dtype=np.int32, usecols=(0,), ndmin=1)
+    # loadtxt 会跳过空行，解析出的值个数必须与行数一致，否则后续像素会错位
+    if values.size != lines:
+        raise ValueError(f"{ppm_path}: 字节 {start}-{end} 内 {lines} 行像素数据解析出 {values.size} 个值")
+    return values
+
+
+def collect_chunks(out, parts, chunks):
+    """将逐段解析结果依次写入预分配的 out，多段时每段完成打印一次进度"""
+    checked = 0
+    for part in parts:
+        if checked + part.size > out.size:
+            raise ValueError(f"PPM 像素数据多于 {out.size:,} 个")
+        out[checked:checked + part.size] = part
+        checked += part.size
+        if chunks > 1:
+            progress = 100 * checked // out.size
+            print(f"  进度: {checked:,}/{out.size:,} ({progress}%)", end='\r')
+    if chunks > 1:
+        print()
+    if checked != out.size:
+        raise ValueError(f"PPM 像素数据只有 {checked:,} 个，应为 {out.size:,} 个")
+
+
+def load_qtop_ppm(ppm_path, width, height, index):
+    """
+    按整行切分 PPM 像素区，多核时并行解析，返回 (height, width) 数组
+
+    index 为 index_lines 的结果，调用方需已确认像素行数与尺寸一致
+    """
+    chunks = max(1, min(os.path.getsize(ppm_path) // MIN_CHUNK_SIZE, height))
+    workers = min(os.cpu_count() or 1, chunks)
+    bounds = [HEADER_LINES + width * (height * k // chunks) for k in range(chunks + 1)]
+    offsets = line_offsets(ppm_path, bounds, index)
+
+    ppm_vals = np.zeros(width * height, dtype=np.int32)
+    lines = [end - start for start, end in zip(bounds, bounds[1:])]
+    args = ([ppm_path] * chunks, offsets[:-1], offsets[1:], lines)
+    if workers == 1:
+        collect_chunks(ppm_vals, map(load_first_channel, *args), chunks)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            collect_chunks(ppm_vals, executor.map(load_first_channel, *args), chunks)
+    return ppm_vals.reshape(height, width)
 
 
 def compare_qtop_outputs(tiff_path, ppm_path):
@@ -100,66 +239,46 @@ def compare_qtop_outputs(tiff_path, ppm_path):
     print(f"C 版本 (TIFF): {arr_tiff.shape}, dtype: {arr_tiff.dtype}")
 
     # 读取 PPM 头部
-    with open(ppm_path, 'r') as f:
-        magic = f.readline().strip()
-        dims = f.readline().strip().split()
-        maxval = f.readline().strip()
+    magic, dims, maxval = (line.decode().strip() for line in read_ppm_header(ppm_path))
 
-        if magic != "P3":
-            print(f"错误: PPM 格式不正确，magic={magic}")
-            return False
+    if magic != "P3":
+        print(f"错误: PPM 格式不正确，magic={magic}")
+        return False
 
-        width, height = int(dims[0]), int(dims[1])
-        print(f"Go 版本 (PPM): {height}x{width}, maxval={maxval}")
+    width, height = map(int, dims.split())
+    print(f"Go 版本 (PPM): {height}x{width}, maxval={maxval}")
 
-        if arr_tiff.shape != (height, width):
-            print(f"错误: 尺寸不匹配")
-            return False
+    if arr_tiff.shape != (height, width):
+        print(f"错误: 尺寸不匹配")
+        return False
 
     print("\n=== 对比像素数据 ===")
     total_pixels = arr_tiff.size
-    batch_size = 10000
-    mismatches = 0
-    checked = 0
-    mismatch_samples = []
-
-    with open(ppm_path, 'r') as f:
-        # 跳过头部
-        f.readline()
-        f.readline()
-        f.readline()
-
-        # 逐批对比
-        for i in range(0, total_pixels, batch_size):
-            batch_end = min(i + batch_size, total_pixels)
-            ppm_batch = []
-
-            for j in range(i, batch_end):
-                line = f.readline().strip()
-                if line:
-                    vals = line.split()
-                    if len(vals) >= 3:
-                        ppm_batch.append(int(vals[0]))
-
-            tiff_batch = arr_tiff.flat[i:batch_end]
-
-            for k, (ppm_val, tiff_val) in enumerate(zip(ppm_batch, tiff_batch)):
-                if ppm_val != int(tiff_val):
-                    mismatches += 1
-                    if len(mismatch_samples) < 10:
-                        pixel_idx = i + k
-                        row = pixel_idx // width
-                        col = pixel_idx % width
-                        mismatch_samples.append(
-                            {'index': pixel_idx, 'row': row, 'col': col, 'ppm': ppm_val, 'tiff': int(tiff_val)}
-                        )
-
-            checked = batch_end
-            if (i // batch_size) % 100 == 0:
-                progress = 100 * checked // total_pixels
-                print(f"  进度: {checked:,}/{total_pixels:,} ({progress}%)", end='\r')
-
-    print(f"\n\n=== 对比结果 ===")
+
+    # 每行一个像素；行索引只扫描一次文件，同时用于校验行数和切分
+    index = index_lines(ppm_path)
+    checked = count_lines(ppm_path, index) - HEADER_LINES
+    if checked != total_pixels:
+        print(f"错误: PPM 像素数不匹配: {checked} != {total_pixels}")
+        return False
+
+    try:
+        ppm_vals = load_qtop_ppm(ppm_path, width, height, index)
+    except ValueError as e:
+        print(f"错误: PPM 像素数据解析失败: {e}")
+        return False
+    mismatch_mask = ppm_vals.ravel() != arr_tiff.ravel()
+    mismatches = int(np.count_nonzero(mismatch_mask))
+
+    # 只为前 10 个不匹配像素构造样本
+    idx = np.flatnonzero(mismatch_mask)[:10]
+    rows, cols = np.divmod(idx, width)
+    mismatch_samples = [
+        {'index': int(i), 'row': int(r), 'col': int(c), 'ppm': int(ppm_vals.flat[i]), 'tiff': int(arr_tiff.flat[i])}
+        for i, r, c in zip(idx, rows, cols)
+    ]
+
+    print(f"\n=== 对比结果 ===")
     print(f"总像素数: {total_pixels:,}")
     print(f"已检查: {checked:,}")
     print(f"不匹配: {mismatches:,}")
@@ -194,13 +313,16 @@ def main():
     print(f"对比文件: {x3f_file}")
     print(f"输出目录: {output_dir}\n")
 
+    # 输出文件名带输入内容哈希，重复对比同一文件时复用已有输出
+    digest = file_digest(x3f_file)
+
     # 生成 C 版本输出
-    tiff_path = generate_c_qtop(x3f_file, output_dir)
+    tiff_path = generate_c_qtop(x3f_file, output_dir, digest)
     if not tiff_path:
         sys.exit(1)
 
     # 生成 Go 版本输出
-    ppm_path = generate_go_qtop(x3f_file, output_dir)
+    ppm_path = generate_go_qtop(x3f_file, output_dir, digest)
     if not ppm_path:
         sys.exit(1)
 
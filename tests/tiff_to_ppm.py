@@ -5,30 +5,40 @@ import sys
 from PIL import Image
 import numpy as np
 
-def tiff_to_ppm(tiff_path, ppm_path):
-    """将TIFF文件转换为PPM P3格式"""
+def tiff_to_ppm(tiff_path, ppm_path, binary=False):
+    """将TIFF文件转换为PPM格式（默认 P3，binary=True 时输出 P6）"""
     # 读取TIFF
     img = Image.open(tiff_path)
     data = np.array(img)
 
     height, width = data.shape
 
-    # 写入PPM P3格式
-    with open(ppm_path, 'w') as f:
-        # PPM头部
-        f.write(f"P3\n{width} {height}\n65535\n")
-
-        # 写入像素数据（灰度图转为R=G=B）
-        for row in data:
-            for val in row:
-                f.write(f"{val} {val} {val} \n")
+    if binary:
+        # 写入PPM P6格式（16 位数据按 PPM 规范使用大端序，R=G=B）
+        with open(ppm_path, 'wb') as f:
+            f.write(b"P6\n%d %d\n65535\n" % (width, height))
+            rgb = np.repeat(data[..., None], 3, axis=2).astype('>u2', copy=False)
+            f.write(rgb.tobytes())
+    else:
+        # 写入PPM P3格式
+        with open(ppm_path, 'w') as f:
+            # PPM头部
+            f.write(f"P3\n{width} {height}\n65535\n")
+
+            # 写入像素数据（灰度图转为R=G=B）
+            # 每行一个像素，格式与 Go 版本一致："%d %d %d \n"
+            # savetxt 每次格式化一整个图像行（最后一个像素的换行由 savetxt 补上）
+            rgb = np.broadcast_to(data[..., None], (*data.shape, 3))
+            np.savetxt(f, rgb.reshape(height, width * 3), fmt='%d %d %d \n' * (width - 1) + '%d %d %d ')
 
     print(f"转换完成: {tiff_path} -> {ppm_path}")
     print(f"尺寸: {width}x{height}")
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print(f"用法: {sys.argv[0]} <input.tiff> <output.ppm>")
+    args = [a for a in sys.argv[1:] if a != "--binary"]
+    if len(args) != 2:
+        print(f"用法: {sys.argv[0]} [--binary] <input.tiff> <output.ppm>")
         sys.exit(1)
 
-    tiff_to_ppm(sys.argv[1], sys.argv[2])
+    binary = "--binary" in sys.argv[1:]
+    tiff_to_ppm(args[0], args[1], binary=binary)